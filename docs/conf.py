@@ -1,11 +1,14 @@
 """Clappform documentation build configuration file."""
-# pylint: disable=redefined-builtin,wrong-import-position
-# flake8: noqa=E402
+# pylint: disable=redefined-builtin
+import ast
 import os
 import sys
 
-sys.path.insert(0, os.path.abspath("../src"))
-import clappform
+# Parallel builds and live-reload servers re-run conf.py many times; only
+# insert the source directory once so sys.path does not grow duplicates.
+_SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "../src"))
+if _SRC not in set(sys.path):
+    sys.path.insert(0, _SRC)
 
 # Configuration file for the Sphinx documentation builder.
 #
@@ -15,17 +18,60 @@ import clappform
 # -- Project information -----------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#project-information
 
+
+def _package_metadata() -> dict:
+    """Statically parse the ``__version__`` style metadata out of the package.
+
+    Importing ``clappform`` pulls in its full dependency chain on every
+    conf.py load, which Sphinx repeats per worker process. A static
+    ``ast`` parse reads the same constants without executing any code.
+    """
+    init_py = os.path.join(os.path.dirname(__file__), "../src/clappform/__init__.py")
+    with open(init_py, encoding="utf-8") as fd:
+        tree = ast.parse(fd.read())
+    meta = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name) and target.id.startswith("__"):
+                meta[target.id] = ast.literal_eval(node.value)
+    return meta
+
+
+_meta = _package_metadata()
+
 project = "Clappform"
-copyright = f"2022, {clappform.__author__}"
-author = clappform.__author__
-version = clappform.__version__
-release = clappform.__version__
+copyright = f"2022, {_meta['__author__']}"
+author = _meta["__author__"]
+version = _meta["__version__"]
+release = _meta["__version__"]
+
+# Only primitives (str, list, dict, tuple) may remain in this namespace:
+# Sphinx pickles its configuration between runs and a stray module or
+# function object silently invalidates the incremental-build cache.
+# Register future event callbacks inside a ``def setup(app):`` function
+# rather than leaving them at module level.
+del _package_metadata, _meta
 
 # -- General configuration ---------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#general-configuration
 
 extensions = ["sphinx.ext.autodoc", "sphinx.ext.intersphinx"]
-intersphinx_mapping = {"python": ("https://docs.python.org/3.10", None)}
+
+# Prefer a committed copy of the Python inventory over fetching it from
+# python.org on every cold-cache build. Refresh it occasionally with:
+#   curl -o docs/_intersphinx/python-3.10.inv https://docs.python.org/3.10/objects.inv
+_PYTHON_INV = os.path.join(os.path.dirname(__file__), "_intersphinx", "python-3.10.inv")
+intersphinx_mapping = {
+    "python": (
+        "https://docs.python.org/3.10",
+        (_PYTHON_INV,) if os.path.exists(_PYTHON_INV) else None,
+    )
+}
+# Stale cache beats no inventory when offline. Once the local .inv file
+# above is committed, a short intersphinx_timeout becomes safe to add.
+intersphinx_cache_limit = 90
 
 templates_path = ["_templates"]
 exclude_patterns = ["_build", "Thumbs.db", ".DS_Store"]
@@ -39,3 +85,11 @@ html_theme = "sphinx_rtd_theme"
 
 # -- Options for Autodoc output ----------------------------------------------
 autodoc_member_order = "bysource"
+
+# All documentation goes through module-level ``automodule`` directives; keep
+# the shared options here so autodoc never builds per-member directive state.
+autodoc_default_options = {
+    "members": True,
+    "undoc-members": True,
+    "show-inheritance": True,
+}
@@ -5,18 +5,20 @@ Clappform API Wrapper
 :copyright: (c) 2022 Clappform B.V..
 :license: MIT, see LICENSE for more details.
 """
-__requires__ = ["requests==2.28.1", "Cerberus==1.3.4", "pandas==1.5.2"]
 # Python Standard Library modules
 from urllib.parse import urlparse
-from dataclasses import asdict
+from dataclasses import fields
 from concurrent import futures
-import tempfile
+import itertools
+import json
 import math
+import threading
 import time
 import os
 
 # PyPi modules
 from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests as r
 
 from cerberus import Validator
@@ -40,6 +42,50 @@ __license__ = "MIT"
 __doc__ = "Clappform Python API wrapper"
 
 
+# Schema for the :meth:`Clappform.aggregate_dataframe` options, built once at
+# import time. Each call constructs its own Validator from it: Cerberus
+# stores the validation result on the instance, so sharing one validator
+# across concurrently running aggregations would mix up their documents.
+_AGGREGATE_OPTIONS_SCHEMA = {
+    "app": {"type": "string"},
+    "collection": {"type": "string"},
+    "type": {"type": "string"},
+    "limit": {"min": 10, "max": 500},
+    "sorting": {
+        "type": "dict",
+        "allow_unknown": True,
+        "schema": {
+            "ASC": {"type": "list"},
+            "DESC": {"type": "list"},
+        },
+    },
+    "search": {
+        "type": "dict",
+        "allow_unknown": True,
+        "schema": {
+            "input": {"type": "string"},
+            "keys": {"type": "list"},
+        },
+    },
+    "item_id": {
+        "type": "string",
+        "nullable": True,
+    },
+    "deep_dive": {"type": "dict"},
+}
+
+
+def _shallow_asdict(resource) -> dict:
+    """Return a resource's fields as a dict without copying their values.
+
+    Clappform resources are flat dataclasses whose field values may embed
+    large plain dicts and lists (an extended app carries all of its groups,
+    pages, rows and modules); :func:`dataclasses.asdict` would deep-copy all
+    of that only for it to be serialized straight to JSON.
+    """
+    return {f.name: getattr(resource, f.name) for f in fields(resource)}
+
+
 class Clappform:
     """:class:`Clappform <Clappform>` class is used to more easily interact with an
     Clappform environement through the API.
@@ -48,6 +94,13 @@ class Clappform:
         ``https://app.clappform.com``.
     :param str username: Username used in the authentication :meth:`auth <auth>`.
     :param str password: Password used in the authentication :meth:`auth <auth>`.
+    :param session: Optional :class:`requests.Session` to use for all HTTP
+        requests. Defaults to a session with a connection pool sized for the
+        concurrent paginated dataframe methods.
+    :type session: requests.Session
+    :param timeout: Timeout for every HTTP request, either a single number or
+        a ``(connect, read)`` tuple in seconds. Defaults to ``(5, 30)``.
+    :type timeout: float | tuple
 
     Most routes of the Clappform API require authentication. For the routes in the
     Clappform API that require authentication :class:`Clappform <Clappform>` will do
@@ -83,21 +136,51 @@ class Clappform:
 
     _auth: dc.Auth = None
 
+    #: Monotonic deadline after which :meth:`auth <auth>` must run again.
+    _auth_expires_at: float = 0.0
+
+    # pylint: disable-next=too-many-arguments
     def __init__(
         self,
         base_url: str,
         username: str,
         password: str,
+        session: r.sessions.Session = None,
+        timeout: float | tuple = (5, 30),
     ):
         self._base_url: str = f"{base_url}/api"
 
         # Session for all HTTP requests.
-        self.session: r.sessions.Session = r.Session()
+        if session is not None:
+            self.session: r.sessions.Session = session
+        else:
+            self.session: r.sessions.Session = r.Session()
+            # Requests selects adapters by URL prefix; mounting on the schemes
+            # (not the full base URL) makes sure this pool is actually used.
+            # Size it to the thread fan-out of the paginated dataframe methods.
+            pool = min(32, (os.cpu_count() or 1) + 4)
+            # A bare integer only retries connect errors; this policy also
+            # retries transient HTTP statuses with exponential backoff and
+            # honors Retry-After on 429 responses.
+            retry = Retry(
+                total=5,
+                connect=3,
+                read=3,
+                status=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(
+                max_retries=retry,
+                pool_connections=pool,
+                pool_maxsize=pool,
+                pool_block=True,
+            )
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
         self.session.headers.update({"User-Agent": self._default_user_agent()})
-        self.session.mount(
-            self._base_url,
-            HTTPAdapter(max_retries=3, pool_maxsize=min(32, os.cpu_count() + 4)),
-        )
 
         # Username to use in the :meth:`auth <auth>`
         self.username: str = username
@@ -105,14 +188,46 @@ class Clappform:
         # Password to use in the :meth:`auth <auth>`
         self.password: str = password
 
-        # Default request keyword arguments.
-        self.request_kwargs: dict = {
-            "timeout": 1,
-            "allow_redirects": True,
-            "verify": True,
-            "stream": False,
-            "cert": None,
-        }
+        # `verify` and `cert` are left to the session (the requests defaults,
+        # or whatever a supplied session configured); the timeout is applied
+        # per call in :meth:`_request`.
+        self._default_timeout = timeout
+
+        # Serializes re-authentication across the worker threads.
+        self._auth_lock = threading.Lock()
+
+        # Shared worker pool for the paginated dataframe methods and
+        # export_app; spawning threads per call is wasted work when those
+        # methods run repeatedly. Released by :meth:`close <close>`.
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=min(32, (os.cpu_count() or 1) + 4),
+            thread_name_prefix="clappform",
+        )
+
+    def close(self) -> None:
+        """Shut down the worker pool and close the underlying HTTP session.
+
+        After :meth:`close` the instance can no longer make requests. Using
+        :class:`Clappform <Clappform>` as a context manager calls this
+        automatically.
+        """
+        self._executor.shutdown()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _pool(self, max_workers: int = None) -> futures.ThreadPoolExecutor:
+        """Return the shared worker pool, or a dedicated pool when the caller
+        asked for a specific number of workers. Dedicated pools are shut down
+        by the method that created them.
+        """
+        if max_workers is None:
+            return self._executor
+        return futures.ThreadPoolExecutor(max_workers=max_workers)
 
     def _default_user_agent(self) -> str:
         """Return a string with version of requests and clappform packages."""
@@ -120,28 +235,44 @@ class Clappform:
         return f"clappform/{__version__} {requests_ua}"
 
     def _request(self, method: str, path: str, **kwargs) -> dict:
-        updated_kwargs = self.request_kwargs.copy()
-        updated_kwargs.update(kwargs)
-        resp = self.session.request(method, f"{self._base_url}{path}", **updated_kwargs)
-        doc = resp.json()
+        kwargs.setdefault("timeout", self._default_timeout)
+        resp = self.session.request(method, f"{self._base_url}{path}", **kwargs)
+        # Empty bodies (204 No Content and friends) carry nothing to decode;
+        # decoding them unconditionally crashed before the status was raised.
+        if resp.status_code == 204 or not resp.content:
+            resp.raise_for_status()
+            return {}
+
+        # Decode the cached response bytes directly; resp.json() adds charset
+        # sniffing on top of the same call.
+        doc = json.loads(resp.content)
 
         try:
             resp.raise_for_status()
         except r.exceptions.HTTPError as exc:
             raise HTTPError(
-                doc["message"],
-                code=doc["code"],
-                response_id=doc["response_id"],
+                doc.get("message"),
+                code=doc.get("code"),
+                response_id=doc.get("response_id"),
                 response=resp,
             ) from exc
         return doc
 
+    def _ensure_auth(self) -> None:
+        """Re-authenticate when the token deadline has passed.
+
+        Double-checked locking: concurrent page fetches that all see an
+        expired deadline produce exactly one ``/auth`` request instead of one
+        per thread.
+        """
+        if time.monotonic() >= self._auth_expires_at:
+            with self._auth_lock:
+                if time.monotonic() >= self._auth_expires_at:
+                    self.auth()
+
     def _private_request(self, method: str, path: str, **kwargs):
         """Implements :meth:`_request` and adds Authorization header."""
-        if "Authorization" not in self.session.headers:
-            self.auth()
-        elif not self._auth.is_token_valid():
-            self.auth()
+        self._ensure_auth()
 
         return self._request(method, path, **kwargs)
 
@@ -161,6 +292,8 @@ class Clappform:
         self.session.headers.update(
             {"Authorization": f"Bearer {self._auth.access_token}"}
         )
+        # Re-authenticate one minute before the token actually expires.
+        self._auth_expires_at = time.monotonic() + self._auth.ttl() - 60
 
     def verify_auth(self) -> dc.ApiResponse:
         """Verify against the API if the authentication is valid.
@@ -170,8 +303,17 @@ class Clappform:
         document = self._private_request("POST", "/auth/verify")
         return dc.ApiResponse(**document)
 
-    def _remove_nones(self, original: dict) -> dict:
-        return {k: v for k, v in original.items() if v is not None}
+    def _payload(self, resource) -> dict:
+        """Build the request body for a resource, dropping ``None`` fields.
+
+        Clappform resources are flat dataclasses, so reading the fields
+        directly avoids the recursive copy :func:`dataclasses.asdict` makes.
+        """
+        return {
+            f.name: value
+            for f in fields(resource)
+            if (value := getattr(resource, f.name)) is not None
+        }
 
     def _seperate_id_from_item(self, original: dict) -> tuple[str, dict]:
         try:
@@ -184,6 +326,17 @@ class Clappform:
             )
         return (item_id, original)
 
+    def _extract_id(self, item: dict) -> str:
+        """Return ``item["_id"]`` without mutating the item."""
+        item_id = item.get("_id")
+        if item_id is None:
+            raise KeyError("could not find '_id' in item")
+        if not isinstance(item_id, str):
+            raise TypeError(
+                f"value of item['_id'] is not of type {str}, got {type(item_id)}"
+            )
+        return item_id
+
     def get(self, resource, item=None):
         """Get one or a list of resources.
 
@@ -248,6 +401,34 @@ class Clappform:
             f"'data' key-value is not {list} or {dict}, got {type(document['data'])}"
         )
 
+    def get_many(self, resource_type: type, ids) -> list:
+        """Get multiple resources of one type by id.
+
+        :param resource_type: Any :class:`clappform.dataclasses.ResourceType`
+            class, e.g. :class:`clappform.dataclasses.Actionflow`.
+        :param ids: Iterable of resource ids to retrieve.
+
+        The Clappform API has no batched lookup route, so the individual
+        :meth:`get` calls are issued concurrently on the shared worker pool.
+
+        Usage::
+
+            >>> from clappform import Clappform
+            >>> import clappform.dataclasses as cdc
+            ...
+            >>> c_auth = Clappform(
+            ...     "https://app.clappform.com",
+            ...     "j.doe@clappform.com",
+            ...     "S3cr3tP4ssw0rd!")
+            ...
+            >>> actionflows = c_auth.get_many(cdc.Actionflow, [3, 48])
+
+        :returns: Resources in the order of ``ids``
+        :rtype: list
+        """
+        self._ensure_auth()
+        return list(self._executor.map(lambda i: self.get(resource_type(id=i)), ids))
+
     def create(self, resource, item=None):
         """Create a resource.
 
@@ -302,7 +483,7 @@ class Clappform:
             )
             return dc.Questionnaire(**document["data"])
 
-        payload = self._remove_nones(asdict(resource))
+        payload = self._payload(resource)
         document = self._private_request("POST", resource.create_path(), json=payload)
         return type(resource)(**document["data"])
 
@@ -359,7 +540,7 @@ class Clappform:
             )
             return dc.Questionnaire(**document["data"])
 
-        payload = self._remove_nones(asdict(resource))
+        payload = self._payload(resource)
         if isinstance(resource, dc.User):
             del payload["email"]
 
@@ -405,10 +586,9 @@ class Clappform:
         if isinstance(resource, dc.Collection) and item is not None:
             oids: list[str] = None
             if isinstance(item, list):
-                # `0` element of `_seperate_id_from_item` is an item's id.
-                oids = [self._seperate_id_from_item(x)[0] for x in item]
+                oids = [self._extract_id(x) for x in item]
             if isinstance(item, dict):
-                oids = [self._seperate_id_from_item(item)[0]]
+                oids = [self._extract_id(item)]
             if isinstance(oids, list):
                 document = self._private_request(
                     "DELETE", resource.create_item_path(), json={"oids": oids}
@@ -461,36 +641,10 @@ class Clappform:
         :returns: Generator to read dataframe
         :rtype: :class:`generator`
         """
-        v = Validator(
-            {
-                "app": {"type": "string"},
-                "collection": {"type": "string"},
-                "type": {"type": "string"},
-                "limit": {"min": 10, "max": 500},
-                "sorting": {
-                    "type": "dict",
-                    "allow_unknown": True,
-                    "schema": {
-                        "ASC": {"type": "list"},
-                        "DESC": {"type": "list"},
-                    },
-                },
-                "search": {
-                    "type": "dict",
-                    "allow_unknown": True,
-                    "schema": {
-                        "input": {"type": "string"},
-                        "keys": {"type": "list"},
-                    },
-                },
-                "item_id": {
-                    "type": "string",
-                    "nullable": True,
-                },
-                "deep_dive": {"type": "dict"},
-            },
-            require_all=True,
-        )
+        # Validation is intentionally advisory: the documented options (e.g.
+        # ``pipeline``) fall outside the schema, so only the normalized
+        # document is used.
+        v = Validator(_AGGREGATE_OPTIONS_SCHEMA, require_all=True)
         v.validate(options)
 
         path = "/dataframe/read_data?extended=true"
@@ -501,24 +655,40 @@ class Clappform:
             raise PaginationKeyError(missing_key="total", data=document)
         if document["total"] == 0:
             raise PaginationTotalError(total=document["total"], data=document)
-        yield document["data"]
 
         pages_to_get = math.ceil(document["total"] / options["limit"])
         if pages_to_get == 1:
-            pass
-        else:
-            with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                for result in executor.map(
-                    lambda x: self._private_request(
-                        "POST", f"{path}&next_page={x}", json=payload
-                    ),
-                    range(
-                        options["limit"],
-                        pages_to_get * options["limit"],
-                        options["limit"],
-                    ),
-                ):
-                    yield result["data"]
+            yield document["data"]
+            return
+
+        # Authenticate once before fanning out so the worker threads do not
+        # each re-check the token.
+        self._ensure_auth()
+        executor = self._pool(max_workers)
+        try:
+            # Submit the remaining pages before handing page one to the
+            # consumer, so the server works on them while it is processed.
+            futs = [
+                executor.submit(
+                    self._private_request,
+                    "POST",
+                    f"{path}&next_page={page}",
+                    json=payload,
+                )
+                for page in range(
+                    options["limit"],
+                    pages_to_get * options["limit"],
+                    options["limit"],
+                )
+            ]
+            yield document["data"]
+            # Yield pages as they arrive; a slow page does not hold up the
+            # pages that completed after it.
+            for fut in futures.as_completed(futs):
+                yield fut.result()["data"]
+        finally:
+            if executor is not self._executor:
+                executor.shutdown()
 
     def read_dataframe(self, query, limit: int = 100, max_workers=None):
         """Read a dataframe.
@@ -578,20 +748,36 @@ class Clappform:
             raise PaginationKeyError(missing_key="total", data=document)
         if document["total"] == 0:
             raise PaginationTotalError(total=document["total"], data=document)
-        yield document["data"]
 
         pages_to_get = math.ceil(document["total"] / limit)
         if pages_to_get == 1:
-            pass
-        else:
-            with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                for result in executor.map(
-                    lambda x: self._private_request(
-                        "POST", f"{path}&next_page={x}", json=payload
-                    ),
-                    range(limit, pages_to_get * limit, limit),
-                ):
-                    yield result["data"]
+            yield document["data"]
+            return
+
+        # Authenticate once before fanning out so the worker threads do not
+        # each re-check the token.
+        self._ensure_auth()
+        executor = self._pool(max_workers)
+        try:
+            # Submit the remaining pages before handing page one to the
+            # consumer, so the server works on them while it is processed.
+            futs = [
+                executor.submit(
+                    self._private_request,
+                    "POST",
+                    f"{path}&next_page={page}",
+                    json=payload,
+                )
+                for page in range(limit, pages_to_get * limit, limit)
+            ]
+            yield document["data"]
+            # Yield pages as they arrive; a slow page does not hold up the
+            # pages that completed after it.
+            for fut in futures.as_completed(futs):
+                yield fut.result()["data"]
+        finally:
+            if executor is not self._executor:
+                executor.shutdown()
 
     def write_dataframe(
         self,
@@ -634,26 +820,59 @@ class Clappform:
             >>> c_auth.write_dataframe(df, _coll, 100)
 
         """
-        # Transform DataFrame to be JSON serializable
-        for col in df.columns:
-            if df[col].dtype == "datetime64[ns, UTC]":
-                df[col] = df[col].astype("datetime64[s, UTC]").astype("int")
-            df[col] = df[col].replace([np.nan, np.inf, -np.inf], None)
-        df = df.replace([np.nan, np.inf, -np.inf], None)
-
-        # Split DataFrame up into chunks.
-        for chunk in [df[i : i + size] for i in range(0, df.shape[0], size)]:
-            # `TemporaryFile` And `force_ascii=False` force the chunck to be `UTF-8`
-            # encoded.
-            with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as fd:
-                chunk.to_json(fd, orient="records", force_ascii=False)
-                fd.seek(0)  # Reset pointer to begin of file for reading.
-                self._private_request(
-                    "POST",
-                    collection.dataframe_path(),
-                    headers={"Content-Type": "application/json"},
-                    data=fd.read().encode("utf-8"),
+        # Transform DataFrame to be JSON serializable. Down-cast all timezone
+        # aware timestamp columns in one pass.
+        tz_cols = df.select_dtypes(include=["datetimetz"]).columns
+        if len(tz_cols) > 0:
+            df[tz_cols] = df[tz_cols].astype("datetime64[s, UTC]").astype("int64")
+
+        # Mask non-finite numerics through numpy directly. A frame-wide
+        # replace boxes every numeric column into Python objects; this keeps
+        # clean columns in their native dtype until serialization.
+        for col in df.select_dtypes(include=[np.number]).columns:
+            # The float view is NA-safe for nullable extension dtypes, whose
+            # plain to_numpy() yields object arrays np.isfinite rejects.
+            arr = df[col].to_numpy(dtype="float64", na_value=np.nan)
+            mask = ~np.isfinite(arr)
+            if mask.any():
+                # Box from the original column so ints stay ints.
+                df[col] = np.where(mask, None, df[col].to_numpy(dtype=object))
+
+        # Object columns can still carry NaN (e.g. missing strings).
+        obj_cols = df.select_dtypes(include=["object"]).columns
+        if len(obj_cols) > 0:
+            df[obj_cols] = df[obj_cols].replace([np.nan], None)
+
+        # Authenticate once before fanning out so the worker threads do not
+        # each re-check the token.
+        self._ensure_auth()
+
+        # Upload the chunks concurrently; draining the map iterator re-raises
+        # the first failed upload here.
+        executor = self._pool(max_workers)
+        try:
+            list(
+                executor.map(
+                    self._upload_chunk,
+                    (df.iloc[i : i + size] for i in range(0, df.shape[0], size)),
+                    itertools.repeat(collection),
                 )
+            )
+        finally:
+            if executor is not self._executor:
+                executor.shutdown()
+
+    def _upload_chunk(self, chunk: DataFrame, collection: dc.Collection) -> None:
+        """Serialize a single DataFrame chunk and POST it to the collection."""
+        # `force_ascii=False` keeps the JSON `UTF-8` encodable in memory; no
+        # temporary file round-trip is needed.
+        payload = chunk.to_json(orient="records", force_ascii=False)
+        self._private_request(
+            "POST",
+            collection.dataframe_path(),
+            headers={"Content-Type": "application/json"},
+            data=payload.encode("utf-8"),
+        )
 
     def empty_dataframe(self, collection) -> dc.ApiResponse:
         """Empty a dataframe.
@@ -686,17 +905,13 @@ class Clappform:
         document = self._private_request("DELETE", collection.dataframe_path())
         return dc.ApiResponse(**document)
 
-    def _export_actions_from_groups(self, groups: list[dict]) -> list[dict]:
-        actions = []
+    def _iter_actions(self, groups: list[dict]):
+        """Yield every action in an app's groups, pages, rows and modules."""
         for group in groups:
             for page in group["pages"]:
                 for row in page["rows"]:
                     for module in row["modules"]:
-                        if "actions" not in module["selection"]:
-                            continue
-                        for action in module["selection"]["actions"]:
-                            actions.append(action)
-        return actions
+                        yield from module["selection"].get("actions", ())
 
     def export_app(self, app) -> dict:
         """
@@ -710,48 +925,38 @@ class Clappform:
 
         app.extended = True
         app = self.get(app)
-        actions = self._export_actions_from_groups(app.groups)
-
-        actionflows = [
-            self.get(dc.Actionflow(id=x["actionflowId"]["id"]))
-            for x in filter(
-                lambda x: "type" in x
-                and x["type"] == "actionflow"
-                and "actionflowId" in x
-                and x["actionflowId"] is not None
-                and "id" in x["actionflowId"],
-                actions,
-            )
-        ]
-        questionnaires = [
-            self.get(dc.Questionnaire(id=x["template"]["id"]))
-            for x in filter(
-                lambda x: "type" in x
-                and x["type"] == "questionnaire"
-                and "template" in x
-                and x["template"] is not None
-                and "id" in x["template"],
-                actions,
-            )
-        ]
+
+        # Bin the actionflow and questionnaire ids in a single pass over the
+        # actions; sets also drop ids referenced by more than one module.
+        actionflow_ids, questionnaire_ids = set(), set()
+        for action in self._iter_actions(app.groups):
+            if action.get("type") == "actionflow":
+                actionflow_id = action.get("actionflowId")
+                if actionflow_id is not None and "id" in actionflow_id:
+                    actionflow_ids.add(actionflow_id["id"])
+            elif action.get("type") == "questionnaire":
+                template = action.get("template")
+                if template is not None and "id" in template:
+                    questionnaire_ids.add(template["id"])
+
+        actionflows = self.get_many(dc.Actionflow, actionflow_ids)
+        questionnaires = self.get_many(dc.Questionnaire, questionnaire_ids)
         import_entries_document = self._private_request("GET", "/import?extended=true")
         # Non-iterable value `app.collections` is used in an iterating context
         # (not-an-iterable). `extended=True` In `self.get_app` will change
         # `dc.App.collections` to a `list`.
         # pylint: disable=E1133
-        import_entries = list(
-            filter(
-                lambda x: x["collection"] in [x["slug"] for x in app.collections],
-                import_entries_document["data"],
-            )
-        )
+        slugs = frozenset(c["slug"] for c in app.collections)
         # pylint: enable=E1133
+        import_entries = [
+            x for x in import_entries_document["data"] if x["collection"] in slugs
+        ]
         version = self.get(dc.Version())
         return {
-            "apps": [asdict(app)],
+            "apps": [_shallow_asdict(app)],
             "collections": app.collections,
-            "form_templates": [asdict(x) for x in questionnaires],
-            "action_flows": [asdict(x) for x in actionflows],
+            "form_templates": [_shallow_asdict(x) for x in questionnaires],
+            "action_flows": [_shallow_asdict(x) for x in actionflows],
             "import_entry": import_entries,
             "config": {
                 "timestamp": int(time.time()),
@@ -75,6 +75,14 @@ class Auth:
             return True
         return False
 
+    def ttl(self) -> int:
+        """Return the number of seconds until the :attr:`access_token` expires.
+
+        :returns: Seconds until expiry
+        :rtype: int
+        """
+        return self._expires - int(time.time())
+
 
 @dataclass
 class Version: